@@ -1,14 +1,26 @@
 # Create a train-test set from Tatoeba
 import argparse
+import functools
+import os
+import shutil
 import tarfile
 import urllib.request
 import re
+import indexed_bzip2
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
 import warnings
 warnings.filterwarnings('ignore')
 from datetime import datetime
+from pathlib import Path
+from types import MappingProxyType
 from sklearn.model_selection import train_test_split
 
+# a number of punctuations I found in the Asian texts, compiled once rather than per sentence
+ASIAN_PUNCTUATION = re.compile(r"[。？?！!，.“”、「」]")
+
 def get_language_mappings(this_path: str) -> pd.DataFrame:
     """
     Load a local file containing mappings between the English names
@@ -29,6 +41,51 @@ def get_language_mappings(this_path: str) -> pd.DataFrame:
     
     return language_mappings
 
+@functools.lru_cache(maxsize=1)
+def get_iso_639_2_English(this_path: str) -> MappingProxyType:
+    """
+    Load the mappings from the ISO 639-2 abbreviations to the English
+    names once & reuse them for later calls with the same path.
+
+    Args:
+    this_path - str; the path to the mappings file.
+
+    Returns:
+    iso_639_2_English - MappingProxyType; read-only mapping from ISO 639-2 abbreviation to English name.
+    """
+    language_mappings = get_language_mappings(this_path=this_path)
+    iso_639_2_English = MappingProxyType(dict(zip(language_mappings["ISO 639-2"], language_mappings["English Name"])))
+    return iso_639_2_English
+
+def read_sentences(this_path: str) -> pd.DataFrame:
+    """
+    Read the Tatoeba sentences straight out of the compressed archive
+    without extracting sentences.csv to disk. The bzip2 blocks are
+    decompressed in parallel.
+
+    Args:
+    this_path - str; the path to the sentences.tar.bz2 archive.
+
+    Returns:
+    sentences - pd.DataFrame; the Tatoeba sentences & their assigned language.
+    """
+    assert isinstance(this_path, str), "this_path is not of type str."
+    assert len(this_path) != 0, "The length of this_path is zero. Submit a path to a file."
+
+    with indexed_bzip2.open(this_path, parallelization=os.cpu_count()) as bz2_file:
+        with tarfile.open(fileobj=bz2_file, mode="r:") as tar:
+            member = next(i for i in tar if i.name.endswith("sentences.csv"))
+            # parse blocks of the file on all cores
+            this_table = pyarrow.csv.read_csv(
+                tar.extractfile(member),
+                read_options=pyarrow.csv.ReadOptions(column_names=["Sentence ID", "Language", "Sentence"], use_threads=True, block_size=16<<20),
+                parse_options=pyarrow.csv.ParseOptions(delimiter="\t"),
+                convert_options=pyarrow.csv.ConvertOptions(column_types={"Language": pa.dictionary(pa.int32(), pa.string())}) # becomes a category, one small int code per row instead of a str
+            )
+    sentences = this_table.to_pandas(split_blocks=True, self_destruct=True, types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get)
+    sentences = sentences.set_index("Sentence ID")
+    return sentences
+
 def get_sentences(min_sentences: int, these_languages: list) -> pd.DataFrame:
     """
     Get the Tatoeba sentences from a local file or download from Tatoeba
@@ -47,31 +104,37 @@ def get_sentences(min_sentences: int, these_languages: list) -> pd.DataFrame:
     assert all(isinstance(i, str) for i in these_languages), "not all elements of these_languages are of type str."
     
     print(f"Getting Tatoeba sentences for {sorted(these_languages)}...")
-    file_path = "sentences.csv"
-    try:
-        sentences = pd.read_csv(file_path, delimiter="\t", header=None, index_col=0, names=["Language", "Sentence"])
-    except:
-        print("...no local file, downloading from Tatoeba...")
-        tatoeba_url = "https://downloads.tatoeba.org/exports/sentences.tar.bz2"
-        response = urllib.request.urlopen(tatoeba_url)
-        tar = tarfile.open(fileobj=response, mode="r|bz2")
-        tar.extractall(path=".")
-        tar.close()
-        sentences = pd.read_csv(file_path, delimiter="\t", header=None, index_col=0, names=["Language", "Sentence"])
+    file_path = "sentences.tar.bz2"
+    parquet_path = "sentences.parquet"
+    if not Path(parquet_path).is_file():
+        if not Path(file_path).is_file():
+            print("...no local file, downloading from Tatoeba...")
+            tatoeba_url = "https://downloads.tatoeba.org/exports/sentences.tar.bz2"
+            # keep the archive compressed on disk, read_sentences decompresses it in parallel
+            # download to a temporary name so an interrupted download isn't mistaken for the archive
+            with urllib.request.urlopen(tatoeba_url) as response, open(f"{file_path}.part", "wb") as part_file:
+                shutil.copyfileobj(response, part_file, length=1<<20) # 1 MiB reads rather than urlretrieve's 8 KiB blocks
+            os.replace(f"{file_path}.part", file_path)
+        sentences = read_sentences(this_path=file_path)
+        # cache the parsed sentences so later runs skip parsing the CSV
+        # write to a temporary name so an interrupted write isn't mistaken for the cache
+        sentences.to_parquet(f"{parquet_path}.part", compression="zstd", row_group_size=1_000_000)
+        os.replace(f"{parquet_path}.part", parquet_path)
+        del sentences
         
     print(f"Filtering sentences based on language and minimum number of sentences...")
-    # find which languages have minimum sentences == min_sentences
-    language_counts = sentences["Language"].value_counts()
-    language_counts = language_counts.to_frame().reset_index()
-    language_counts.rename(columns={"index":"ISO 639-2 Name", "Language": "Count"}, inplace=True)
-    # map from these_languages to ISO 639-2 & filter
-    language_mappings = get_language_mappings(this_path="language_mappings.csv")
-    language_mappings = language_mappings[language_mappings["English Name"].isin(these_languages)]
-    iso_639_2_English = language_mappings[["ISO 639-2", "English Name"]].set_index(keys="ISO 639-2")["English Name"].to_dict()
-    language_counts["English Name"] = language_counts["ISO 639-2 Name"].map(iso_639_2_English)
+    # find which languages have minimum sentences == min_sentences, only the Language column is read
+    language_counts = pd.read_parquet(parquet_path, columns=["Language"])["Language"].value_counts()
+    # map from these_languages to ISO 639-2
+    iso_639_2_English = {k: v for k, v in get_iso_639_2_English(this_path="language_mappings.csv").items() if v in these_languages}
     # filter by languages with min_sentences & in these_languages using 3 digit language identifier: ISO 639-2 Name
-    language_filter = language_counts[(language_counts["Count"]>=min_sentences)&(~language_counts["English Name"].isna())]["ISO 639-2 Name"].tolist()
-    result = sentences[sentences["Language"].isin(language_filter)]
+    language_filter = [i for i in iso_639_2_English if language_counts.get(i, 0)>=min_sentences]
+    if language_filter:
+        # only load sentences in language_filter, the filter is applied to each row group as it's read
+        result = pd.read_parquet(parquet_path, columns=["Language", "Sentence"], filters=[("Language", "in", language_filter)])
+        result["Language"] = result["Language"].cat.remove_unused_categories()
+    else:
+        result = pd.DataFrame(columns=["Language", "Sentence"])
     if result.empty: print("No sentences found for given language/minimum sentence criteria...")
     else: print(f"...languages in sample: {sorted([iso_639_2_English[i] for i in language_filter])}...")
     return result
@@ -91,7 +154,7 @@ def get_sentence_word_char_len(this_row: pd.Series) -> int:
     this_language = this_row["Language"]
     this_text = this_row["Sentence"]
     # remove punctuation from this_text
-    this_text = re.sub(r"[。？?！!，.“”、「」]", "", this_text) # the pattern is just a number of punctuations I found in the Asian texts
+    this_text = ASIAN_PUNCTUATION.sub("", this_text)
     if this_language in ["Chinese", "Japanese", "Korean", "cmn", "jpn", "kor"]:
         this_text = re.sub(r"\s", "", this_text) # remove whitespace chars
         result = len(this_text)
@@ -99,7 +162,51 @@ def get_sentence_word_char_len(this_row: pd.Series) -> int:
         result = len(this_text.split())
     return result
 
-def take_sample(these_sentences: pd.DataFrame, sample_type: str) -> pd.DataFrame:
+def get_sentences_word_char_len(these_sentences: pd.DataFrame) -> pd.Series:
+    """
+    Vectorized version of get_sentence_word_char_len for a whole DataFrame
+    of sentences, counting characters for Chinese, Japanese & Korean and
+    words for every other language.
+
+    Args:
+    these_sentences - pd.DataFrame; sentences & their assigned language.
+
+    Returns:
+    result - pd.Series; the count of words or characters in each sentence.
+    """
+    assert isinstance(these_sentences, pd.DataFrame), "these_sentences is not of type pd.DataFrame."
+    # remove punctuation from the sentences
+    these_texts = these_sentences["Sentence"].str.replace(ASIAN_PUNCTUATION, "", regex=True)
+    is_cjk = these_sentences["Language"].isin(["Chinese", "Japanese", "Korean", "cmn", "jpn", "kor"])
+    result = pd.Series(0, index=these_sentences.index, dtype="int64")
+    # count non-whitespace chars & whitespace separated words without building new strings or lists
+    result[is_cjk] = these_texts[is_cjk].str.count(r"\S")
+    result[~is_cjk] = these_texts[~is_cjk].str.count(r"\S+")
+    return result
+
+def sample_languages(these_sentences: pd.DataFrame, max_sample_size, rng: np.random.Generator, by: tuple = ("Language",)) -> pd.DataFrame:
+    """
+    Randomly pick up to max_sample_size sentences from each group by
+    ranking a random number within each group & keeping the lowest ranks.
+
+    Args:
+    these_sentences - pd.DataFrame; sentences & their assigned language.
+    max_sample_size - int or np.ndarray; the number of sentences to keep per group, or for each sentence the number to keep from its group.
+    rng - np.random.Generator; the random number generator shared by all samples.
+    by - tuple; the columns to group the sentences by.
+
+    Returns:
+    this_sample - pd.DataFrame; a subset of sentences.
+    """
+    assert isinstance(these_sentences, pd.DataFrame), "these_sentences is not of type pd.DataFrame."
+    assert isinstance(rng, np.random.Generator), "rng is not of type np.random.Generator."
+    assert isinstance(by, tuple), "by is not of type tuple."
+    random_rank = pd.Series(rng.random(len(these_sentences)), index=these_sentences.index)
+    random_rank = random_rank.groupby([these_sentences[i] for i in by], observed=True).rank(method="first")
+    this_sample = these_sentences[random_rank<=max_sample_size]
+    return this_sample
+
+def take_sample(these_sentences: pd.DataFrame, sample_type: str, rng: np.random.Generator) -> pd.DataFrame:
     """
     Take a random sample from a DataFrame containing Tatoeba sentences
     with each language contributing no more than the minimum number
@@ -108,6 +215,7 @@ def take_sample(these_sentences: pd.DataFrame, sample_type: str) -> pd.DataFrame
     Args:
     these_sentences - pd.DataFrame; sentences & their assigned language.
     sample_type - str; the type of sample to take: "random" or "stratify"
+    rng - np.random.Generator; the random number generator shared by all samples.
 
     Returns:
     this_sample - pd.DataFrame; a subset of sentences.
@@ -116,36 +224,58 @@ def take_sample(these_sentences: pd.DataFrame, sample_type: str) -> pd.DataFrame
     assert not these_sentences.empty, "these_sentences is an empty DataFrame."
     assert isinstance(sample_type, str), "sample_type is not of type str."
     assert sample_type in ["random", "stratify"], 'sample_type is not "random" or "stratify"'
+    assert isinstance(rng, np.random.Generator), "rng is not of type np.random.Generator."
     print(f"Taking a {'stratified' if sample_type=='stratify' else 'random'} sample...")
     
     if sample_type == "random":
         # TODO: implement a better way of limiting total sample size while considering the size of individual languges in subset of corpus so train-test isn't huge
-        max_sample_size = int(these_sentences["Language"].value_counts().min() / 1000) * 1000
+        # count sentences per language in a single pass over the category codes
+        language_counts = np.bincount(these_sentences["Language"].cat.codes.values)
+        max_sample_size = int(language_counts[language_counts>0].min() / 1000) * 1000
         print(f"...of {max_sample_size} sentences per language.")
-        this_sample = these_sentences.groupby("Language", group_keys=False).apply(lambda x: x.sample(max_sample_size))
+        this_sample = sample_languages(these_sentences, max_sample_size, rng)
     elif sample_type == "stratify":
-        # call get_sentence_word_char_len
-        these_sentences["Sentence_word_char_len"] = these_sentences.apply(lambda row: get_sentence_word_char_len(row), axis=1)
-        # only keep sentences with <201 chars
-        these_sentences = these_sentences[these_sentences["Sentence_word_char_len"]<100]
-        # bin sentences by len
+        # call get_sentences_word_char_len, get_sentences already dropped the other languages while reading
+        these_sentences["Sentence_word_char_len"] = get_sentences_word_char_len(these_sentences)
+        # only keep sentences with 1 to 99 words/chars
+        these_sentences = these_sentences[(these_sentences["Sentence_word_char_len"]>0)&(these_sentences["Sentence_word_char_len"]<100)]
+        # bin sentences by len, bin i holds lens in (bin_edges[i], bin_edges[i+1]]
         bin_labels = ["1","2","3","4","5","6","7","8","9","10","11 to 16", "17 to 27", "28 to 48", "49 to 99"]
-        these_sentences["bin"] = pd.cut(
-            x=these_sentences["Sentence_word_char_len"],
-            bins=[0,1,2,3,4,5,6,7,8,9,10,16,27,48,99],
-            labels=bin_labels
-        )
-        # iterate through bins & take sample for that bin
-        this_sample = pd.DataFrame()
-        for this_bin in bin_labels:
-            temp_sample = these_sentences[these_sentences["bin"]==this_bin]
-            # find max sample size
-            max_sample_size = temp_sample["Language"].value_counts(normalize=False).min()
-            print(f"...of {max_sample_size} sentences per language for bin = {this_bin}.")
-            temp_sample = temp_sample.groupby("Language", group_keys=False).apply(lambda x: x.sample(max_sample_size))
-            this_sample = this_sample.append(temp_sample)
+        bin_edges = np.array([0,1,2,3,4,5,6,7,8,9,10,16,27,48,99])
+        these_sentences["bin"] = (np.searchsorted(bin_edges, these_sentences["Sentence_word_char_len"].values, side="left") - 1).astype("int8")
+        # count sentences per bin & language in a single pass over the category codes
+        # both codes are int8, upcast so the combined key doesn't overflow with 10+ languages
+        number_languages = len(these_sentences["Language"].cat.categories)
+        bin_language_counts = np.bincount(
+            these_sentences["bin"].values.astype(np.int64) * number_languages + these_sentences["Language"].cat.codes.values.astype(np.int64),
+            minlength=len(bin_labels) * number_languages
+        ).reshape(len(bin_labels), number_languages)
+        # find max sample size for each bin, ignoring languages without sentences in that bin
+        max_sample_sizes = np.zeros(len(bin_labels), dtype="int64")
+        for bin_code, this_bin in enumerate(bin_labels):
+            language_counts = bin_language_counts[bin_code]
+            if language_counts.any(): max_sample_sizes[bin_code] = language_counts[language_counts>0].min()
+            print(f"...of {max_sample_sizes[bin_code]} sentences per language for bin = {this_bin}.")
+        # take the sample for all bins at once
+        this_sample = sample_languages(these_sentences, max_sample_sizes[these_sentences["bin"].values], rng, by=("Language", "bin"))
     return this_sample
 
+def save_sample(this_sample: pd.DataFrame, this_path: str) -> None:
+    """
+    Save a train or test sample to a CSV file with the multithreaded
+    pyarrow CSV writer, keeping the Tatoeba index as "Original Index".
+
+    Args:
+    this_sample - pd.DataFrame; sentences & their assigned language.
+    this_path - str; the path to the output file.
+    """
+    assert isinstance(this_sample, pd.DataFrame), "this_sample is not of type pd.DataFrame."
+    assert isinstance(this_path, str), "this_path is not of type str."
+    assert len(this_path) != 0, "The length of this_path is zero. Submit a path to a file."
+
+    this_table = pa.Table.from_pandas(this_sample.rename_axis("Original Index").reset_index(), preserve_index=False)
+    pyarrow.csv.write_csv(this_table, this_path)
+
 def main():
     # parse args
     parser = argparse.ArgumentParser()
@@ -194,33 +324,43 @@ def main():
         help="number of train-test sets to generate",
         required=False
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="seed for the random samples & train-test splits, for reproducible output",
+        required=False
+    )
     args = parser.parse_args()
     if args.languages:
         args.languages = [i.title() for i in args.languages]
     
+    # one generator for every sample & split so runs with the same --seed are reproducible
+    rng = np.random.default_rng(args.seed)
     counter = 0
     for sample in range(args.number_sets):
         # get sentences, take sample, create train & test
         sentences = get_sentences(min_sentences=args.minimum_sentences, these_languages=args.languages)
         if not sentences.empty:
-            sample = take_sample(sentences, args.sample_type)
+            sample = take_sample(sentences, args.sample_type, rng)
             y = sample["Language"]
             X_train, X_test, y_train, y_test = train_test_split(
                 sample["Sentence"],
                 y,
                 train_size=0.8,
                 shuffle=True,
-                stratify=y
+                stratify=y,
+                random_state=int(rng.integers(2**32))
             )
             # combine train & test into DFs & save each in output/
-            train = X_train.to_frame().merge(right=y_train, how="inner", left_index=True, right_index=True)
-            test = X_test.to_frame().merge(right=y_test, how="inner", left_index=True, right_index=True)
+            train = pd.concat([X_train, y_train], axis=1, copy=False) # train_test_split keeps X & y aligned, no join needed
+            test = pd.concat([X_test, y_test], axis=1, copy=False)
 
             # save train & test files
             now = datetime.now()
             datetime_stamp = f"{now.year}-{now.month}-{now.day}_{now.hour}{now.minute}"
-            train.to_csv(f"output/Tatoeba_{args.sample_type}_train_{datetime_stamp}.csv", index_label="Original Index")
-            test.to_csv(f"output/Tatoeba_{args.sample_type}_test_{datetime_stamp}.csv", index_label="Original Index")
+            save_sample(train, f"output/Tatoeba_{args.sample_type}_train_{datetime_stamp}.csv")
+            save_sample(test, f"output/Tatoeba_{args.sample_type}_test_{datetime_stamp}.csv")
             counter += 1
             print("Train & test files saved to output/")
         else: